@@ -17,12 +17,19 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 02110-1301  USA
 """
 
+import errno
+import fcntl
+import fnmatch
+import functools
 import glob
-import os.path
-import shutil
-from typing import List
+import itertools
+import os
+import platform
+import stat
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-from cobbler import templar
 from cobbler import utils
 from cobbler import tftpgen
 
@@ -30,6 +37,32 @@ from cobbler.cexceptions import CX
 from cobbler.manager import ManagerModule
 
 MANAGER = None
+_MANAGER_LOCK = Lock()
+
+# Size of the buffer used when neither copy_file_range() nor sendfile() can be used.
+_COPY_BUFSIZE = 1024 * 1024
+# errno values signalling that a zero-copy syscall is not usable for the given pair of files.
+_ZERO_COPY_UNSUPPORTED = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+)
+# ioctl request to share all extents of a file with another file (reflink), see ioctl_ficlone(2). 0x40049409 is the
+# generic _IOW(0x94, 9, int) encoding used by x86, arm, s390 and riscv. Other architectures (e.g. ppc64) encode it
+# differently, there the ioctl is not attempted and the data is always copied.
+_FICLONE = (
+    0x40049409
+    if platform.machine()
+    in ("x86_64", "i386", "i686", "aarch64", "armv7l", "armv8l", "s390x", "riscv64")
+    else None
+)
+# Separates the boot_files paths when they are rendered in a single pass.
+_RENDER_SEPARATOR = "\n\x00\n"
+_GLOB_CHARACTERS = "*?["
+# Anything Templar.render() could replace: Cheetah placeholders and directives, Jinja2 blocks and "@@key@@" lookups
+_TEMPLATE_MARKERS = ("$", "#", "{{", "{%", "@@", "TEMPLATE::")
 
 
 def register() -> str:
@@ -39,6 +72,148 @@ def register() -> str:
     return "manage"
 
 
+def _copy_fd(src_fd: int, dst_fd: int, size: int):
+    """
+    Copy the content of ``src_fd`` to ``dst_fd``, starting at the current offsets of both descriptors.
+
+    ``os.copy_file_range()`` is tried first (server-side copy on NFSv4.2, reflink on btrfs/xfs), then
+    ``os.sendfile()``. If the kernel refuses both for this pair of files, a plain read/write loop with a reusable
+    buffer is used. Because all methods advance the file offsets a fallback picks up where the previous one stopped.
+
+    :param src_fd: The file descriptor to read from.
+    :param dst_fd: The file descriptor to write to.
+    :param size: The number of bytes expected to be copied.
+    """
+    remaining = size
+    if hasattr(os, "copy_file_range"):
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(src_fd, dst_fd, remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            # Some filesystems return 0 instead of an error, so 0 only means end of file once data was copied.
+            if remaining < size or remaining == 0:
+                return
+        except OSError as error:
+            if error.errno not in _ZERO_COPY_UNSUPPORTED:
+                raise
+
+    if hasattr(os, "sendfile"):
+        try:
+            while remaining > 0:
+                sent = os.sendfile(dst_fd, src_fd, None, remaining)
+                if sent == 0:
+                    break
+                remaining -= sent
+            if remaining < size or remaining == 0:
+                return
+        except OSError as error:
+            if error.errno not in _ZERO_COPY_UNSUPPORTED:
+                raise
+
+    buffer = memoryview(bytearray(_COPY_BUFSIZE))
+    with open(src_fd, "rb", buffering=0, closefd=False) as src_file, open(
+        dst_fd, "wb", closefd=False
+    ) as dst_file:
+        while True:
+            read = src_file.readinto(buffer)
+            if not read:
+                break
+            dst_file.write(buffer[:read])
+
+
+def _fast_copyfile(src: str, dst: str, exclusive: bool = False):
+    """
+    Copy the file ``src`` to ``dst`` without moving the data through userspace where the kernel allows it. On
+    copy-on-write filesystems (btrfs, xfs) the file is cloned with the ``FICLONE`` ioctl, which only shares the extents
+    and takes the same time for any file size. Otherwise the data is copied by ``_copy_fd()``.
+
+    :param src: The source file.
+    :param dst: The destination file. It is created or truncated.
+    :param exclusive: If True, ``dst`` must not exist yet. This replaces a separate existence check.
+    :raises FileExistsError: Raised in case ``exclusive`` is set and ``dst`` already exists.
+    :raises OSError: Raised in case ``src`` is not a regular file. Nothing is created at ``dst`` then.
+    """
+    dst_flags = os.O_WRONLY | os.O_CREAT
+    dst_flags |= os.O_EXCL if exclusive else os.O_TRUNC
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        src_stat = os.fstat(src_fd)
+        if not stat.S_ISREG(src_stat.st_mode):
+            raise OSError(errno.EINVAL, "Not a regular file", src)
+        dst_fd = os.open(dst, dst_flags, 0o666)
+        try:
+            if _FICLONE is not None:
+                try:
+                    fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+                    return
+                except OSError as error:
+                    if error.errno not in _ZERO_COPY_UNSUPPORTED:
+                        raise
+            _copy_fd(src_fd, dst_fd, src_stat.st_size)
+        except BaseException:
+            # An exclusively created destination would otherwise be skipped by every later sync.
+            if exclusive:
+                os.unlink(dst)
+            raise
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _is_template(path: str) -> bool:
+    """
+    Check if ``path`` could change when rendered with ``Templar.render()``.
+
+    :param path: The path to check.
+    :return: False if ``path`` is plain text that the templating engines return as is.
+    """
+    return any(marker in path for marker in _TEMPLATE_MARKERS)
+
+
+def _has_glob_characters(path: str) -> bool:
+    """
+    Check if ``path`` contains any wildcard that ``glob.glob()`` would expand.
+
+    :param path: The path to check.
+    :return: True if ``path`` is a glob pattern.
+    """
+    return any(character in path for character in _GLOB_CHARACTERS)
+
+
+def _cached_glob(pattern: str, dir_cache: Dict[str, List[str]]) -> List[str]:
+    """
+    Return the paths matching ``pattern`` like ``glob.glob()`` does, listing every directory only once per
+    ``dir_cache``. Only the last path component is matched against the cached listing, patterns with wildcards in the
+    directory part are handed to ``glob.glob()``.
+
+    :param pattern: The path or glob pattern to resolve.
+    :param dir_cache: Maps directories to the names of their entries. Missing directories are listed and added.
+    :return: The existing paths matching ``pattern``.
+    """
+    parent, name_pattern = os.path.split(pattern)
+    if not _has_glob_characters(name_pattern):
+        if _has_glob_characters(parent):
+            return glob.glob(pattern)
+        return [pattern] if os.path.lexists(pattern) else []
+    if _has_glob_characters(parent):
+        return glob.glob(pattern)
+
+    if parent not in dir_cache:
+        try:
+            with os.scandir(parent or os.curdir) as entries:
+                dir_cache[parent] = [entry.name for entry in entries]
+        except OSError:
+            dir_cache[parent] = []
+    names = dir_cache[parent]
+    if not name_pattern.startswith("."):
+        # glob.glob() hides dotfiles unless the pattern asks for them explicitly
+        names = [name for name in names if not name.startswith(".")]
+    return [os.path.join(parent, name) for name in fnmatch.filter(names, name_pattern)]
+
+
 class _InTftpdManager(ManagerModule):
     @staticmethod
     def what() -> str:
@@ -55,6 +230,127 @@ class _InTftpdManager(ManagerModule):
         self.tftpgen = tftpgen.TFTPGen(api)
         self.bootloc = api.settings().tftpboot_location
         self.webdir = api.settings().webdir
+        # (version, menu items) of the last menu build, see _get_menu_items()
+        self._menu_items_cache: Optional[Tuple[tuple, dict]] = None
+
+    @staticmethod
+    def _run_parallel(tasks: Iterable[Callable[[], None]]):
+        """
+        Call every task using a thread pool. The tasks are I/O bound (file copies and rendered templates written to
+        disk) and independent of each other, so they may overlap.
+
+        :param tasks: The callables to run, they don't receive any arguments.
+        :raises Exception: The first exception raised by a task is re-raised after all tasks have finished.
+        """
+        max_workers = min(32, (os.cpu_count() or 4) * 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(task) for task in tasks]
+            for future in as_completed(futures):
+                future.result()
+
+    def _menu_items_version(self) -> tuple:
+        """
+        Fingerprint of the items the menu is built from. Adding, removing or saving (which updates ``mtime``) a distro,
+        profile, image or menu changes it.
+
+        :return: The number of items and the latest ``mtime`` of every collection involved.
+        """
+        return tuple(
+            (len(collection), max((item.mtime for item in collection), default=0.0))
+            for collection in (
+                self.distros,
+                self.profiles,
+                self.api.images(),
+                self.api.menus(),
+            )
+        )
+
+    def _get_menu_items(self) -> dict:
+        """
+        Return the menu items for all boot loaders, building them only if the distros, profiles, images or menus
+        changed since the last build. ``sync()`` and ``sync_systems()`` always rebuild them.
+
+        :return: The menu items as returned by ``TFTPGen.get_menu_items()``.
+        """
+        version = self._menu_items_version()
+        cache = self._menu_items_cache
+        if cache is None or cache[0] != version:
+            cache = (version, self.tftpgen.get_menu_items())
+            self._menu_items_cache = cache
+        return cache[1]
+
+    def _copy_one_distro(self, distro):
+        """
+        Copy the kernel and initrd of a single distro to the TFTP server folder.
+
+        :param distro: The distro to copy the files for.
+        """
+        # Adding in the exception handling to not blow up if files have been moved (or the path references an NFS
+        # directory that's no longer mounted)
+        try:
+            self.logger.info("copying files for distro: %s", distro.name)
+            self.tftpgen.copy_single_distro_files(distro, self.bootloc, False)
+        except CX as e:
+            self.logger.error(e.value)
+
+    @staticmethod
+    def _copy_boot_file(src: str, dst: str, hardlink: bool):
+        """
+        Hardlink ``src`` to ``dst`` if allowed, otherwise copy it. A hardlink moves no data at all.
+
+        :param src: The source file.
+        :param dst: The destination file, it must not exist yet.
+        :param hardlink: Whether ``utils.is_safe_to_hardlink()`` allows a hardlink for this file.
+        :raises FileExistsError: Raised in case ``dst`` already exists.
+        """
+        if hardlink:
+            try:
+                os.link(src, dst)
+                return
+            except FileExistsError:
+                raise
+            except OSError:
+                # e.g. EXDEV for bind mounts or EPERM with protected_hardlinks, so just copy it
+                pass
+        _fast_copyfile(src, dst, exclusive=True)
+
+    def _render_boot_files(
+        self, boot_files: Dict[str, str], metadata: dict
+    ) -> List[Tuple[str, str]]:
+        """
+        Render the target and source paths of all ``boot_files`` with a single call to the templating engine.
+
+        :param boot_files: The boot files of a distro, mapping the target path to the source path.
+        :param metadata: The metadata to render the paths with.
+        :return: The rendered (target, source) pairs in the order of ``boot_files``.
+        """
+        paths = list(itertools.chain.from_iterable(boot_files.items()))
+        # Plain paths come out of the templating engine unchanged, so only the others are handed to it.
+        template_indexes = [
+            index for index, path in enumerate(paths) if _is_template(path)
+        ]
+        templates = [paths[index] for index in template_indexes]
+        rendered = []
+        # Cheetah directives (e.g. "#set"), Jinja2 statements (e.g. "{% set %}") and multi-line paths would affect the
+        # paths rendered after them, so these are only rendered one by one. This also covers a "#template=" header
+        # selecting the template type.
+        if templates and not any(
+            "\n" in path or "#" in path or "{%" in path for path in templates
+        ):
+            rendered = self.templar.render(
+                _RENDER_SEPARATOR.join(templates), metadata, None
+            ).split(_RENDER_SEPARATOR)
+        if len(rendered) == len(templates):
+            # Templar.render() strips leading newlines of its whole output, so do the same for every single path.
+            rendered = [
+                path.lstrip() if path.startswith("\n") else path for path in rendered
+            ]
+        else:
+            # A path contains a directive or a newline, or rendered to something containing the separator.
+            rendered = [self.templar.render(path, metadata, None) for path in templates]
+        for index, path in zip(template_indexes, rendered):
+            paths[index] = path
+        return list(zip(paths[::2], paths[1::2]))
 
     def write_boot_files_distro(self, distro):
         # Collapse the object down to a rendered datastructure.
@@ -68,38 +364,54 @@ class _InTftpdManager(ManagerModule):
         metadata["web_img_path"] = os.path.join(
             self.webdir, "distro_mirror", distro.name
         )
-        # Create the templar instance.  Used to template the target directory
-        templater = templar.Templar(self.api)
+
+        # Directories already created for globbed boot files, to avoid stat()ing them for every match
+        created_dirs = set()
+        # Listings of the source directories, as many boot files are usually globbed from the same directory
+        dir_cache = {}
 
         # Loop through the dict of boot files, executing a cp for each one
-        self.logger.info("processing boot_files for distro: %s" % distro.name)
-        for boot_file in list(target["boot_files"].keys()):
-            rendered_target_file = templater.render(boot_file, metadata, None)
-            rendered_source_file = templater.render(
-                target["boot_files"][boot_file], metadata, None
-            )
+        self.logger.info("processing boot_files for distro: %s", distro.name)
+        copied_count = 0
+        for rendered_target_file, rendered_source_file in self._render_boot_files(
+            target["boot_files"], metadata
+        ):
+            # For globs the matched files are copied into the directory of the target
+            is_glob = _has_glob_characters(rendered_source_file)
+            rnd_path = os.path.dirname(rendered_target_file)
+            # All matches go from the same source directory to the same target directory, so only check this once.
+            # For globs the check sees the pattern, which is conservative with SELinux as only kernel and initrd names
+            # may be hardlinked then.
+            hardlink = None
             try:
-                for file in glob.glob(rendered_source_file):
-                    if file == rendered_source_file:
+                for file in _cached_glob(rendered_source_file, dir_cache):
+                    if not is_glob:
                         # this wasn't really a glob, so just copy it as is
                         filedst = rendered_target_file
                     else:
                         # this was a glob, so figure out what the destination file path/name should be
-                        tgt_path, tgt_file = os.path.split(file)
-                        rnd_path, rnd_file = os.path.split(rendered_target_file)
-                        filedst = os.path.join(rnd_path, tgt_file)
+                        filedst = os.path.join(rnd_path, os.path.basename(file))
 
-                        if not os.path.isdir(rnd_path):
+                        if rnd_path not in created_dirs:
                             utils.mkdir(rnd_path)
-                    if not os.path.isfile(filedst):
-                        shutil.copyfile(file, filedst)
-                    self.logger.info(
+                            created_dirs.add(rnd_path)
+                    if hardlink is None:
+                        hardlink = utils.is_safe_to_hardlink(
+                            rendered_source_file, filedst, self.api
+                        )
+                    try:
+                        self._copy_boot_file(file, filedst, hardlink)
+                    except FileExistsError:
+                        continue
+                    copied_count += 1
+                    self.logger.debug(
                         "copied file %s to %s for %s", file, filedst, distro.name
                     )
             except:
                 self.logger.error(
                     "failed to copy file %s to %s for %s", file, filedst, distro.name
                 )
+        self.logger.info("copied %d files for distro %s", copied_count, distro.name)
 
         return 0
 
@@ -122,7 +434,7 @@ class _InTftpdManager(ManagerModule):
         :param menu_items: The menu items to add
         """
         if not menu_items:
-            menu_items = self.tftpgen.get_menu_items()
+            menu_items = self._get_menu_items()
         self.tftpgen.write_all_system_files(system, menu_items)
         # generate any templates listed in the distro
         self.tftpgen.write_templates(system)
@@ -151,16 +463,21 @@ class _InTftpdManager(ManagerModule):
 
         system_objs = []
         for system_name in systems:
-            # get the system object:
+            # get the system object. A lookup by name alone is a dict access in the collection, so there is no need to
+            # index self.systems here.
             system_obj = self.api.find_system(name=system_name)
             if system_obj is None:
                 self.logger.info("did not find any system named %s", system_name)
                 continue
             system_objs.append(system_obj)
 
-        menu_items = self.tftpgen.get_menu_items()
-        for system in system_objs:
-            self.sync_single_system(system, menu_items)
+        # Changes to settings or templates are not part of the menu items version, so rebuild unconditionally here.
+        self._menu_items_cache = None
+        menu_items = self._get_menu_items()
+        self._run_parallel(
+            functools.partial(self.sync_single_system, system, menu_items)
+            for system in system_objs
+        )
 
         self.logger.info("generating PXE menu structure")
         self.tftpgen.make_pxe_menu()
@@ -175,25 +492,22 @@ class _InTftpdManager(ManagerModule):
         self.logger.info("copying bootloaders")
         self.tftpgen.copy_bootloaders(self.bootloc)
 
-        self.logger.info("copying distros to tftpboot")
-
-        # Adding in the exception handling to not blow up if files have been moved (or the path references an NFS
-        # directory that's no longer mounted)
-        for d in self.distros:
-            try:
-                self.logger.info("copying files for distro: %s", d.name)
-                self.tftpgen.copy_single_distro_files(d, self.bootloc, False)
-            except CX as e:
-                self.logger.error(e.value)
-
-        self.logger.info("copying images")
-        self.tftpgen.copy_images()
-
+        # The PXE configuration files only reference the distro and image files by path, so all of them can be written
+        # while the files are still being copied.
+        self.logger.info(
+            "copying distros and images to tftpboot, generating PXE configuration files"
+        )
+        # Changes to settings or templates are not part of the menu items version, so rebuild unconditionally here.
+        self._menu_items_cache = None
+        menu_items = self._get_menu_items()
+        tasks = [functools.partial(self._copy_one_distro, d) for d in self.distros]
+        tasks.append(self.tftpgen.copy_images)
         # the actual pxelinux.cfg files, for each interface
-        self.logger.info("generating PXE configuration files")
-        menu_items = self.tftpgen.get_menu_items()
-        for system in self.systems:
-            self.tftpgen.write_all_system_files(system, menu_items)
+        tasks.extend(
+            functools.partial(self.tftpgen.write_all_system_files, system, menu_items)
+            for system in self.systems
+        )
+        self._run_parallel(tasks)
 
         self.logger.info("generating PXE menu structure")
         self.tftpgen.make_pxe_menu()
@@ -209,6 +523,9 @@ def get_manager(api):
     # Singleton used, therefore ignoring 'global'
     global MANAGER  # pylint: disable=global-statement
 
-    if not MANAGER:
-        MANAGER = _InTftpdManager(api)
+    if MANAGER is None:
+        with _MANAGER_LOCK:
+            # Another thread may have created the manager while this one waited for the lock.
+            if MANAGER is None:
+                MANAGER = _InTftpdManager(api)
     return MANAGER
@@ -1,8 +1,14 @@
+import errno
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, Mock
 
 import pytest
 
 from cobbler.api import CobblerAPI
+from cobbler.cexceptions import CX
 from cobbler.modules.managers import in_tftpd
 from cobbler.tftpgen import TFTPGen
 from cobbler.items.distro import Distro
@@ -187,3 +193,346 @@ def test_manager_sync(mocker, api_mock_tftp, reset_singleton):
     assert manager_obj.tftpgen.get_menu_items.call_count == 1
     assert manager_obj.tftpgen.write_all_system_files.call_count == 1
     assert manager_obj.tftpgen.make_pxe_menu.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "unsupported_calls",
+    [
+        [],
+        ["copy_file_range"],
+        ["copy_file_range", "sendfile"],
+    ],
+)
+def test_fast_copyfile(mocker, tmp_path, unsupported_calls):
+    # Arrange
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    src.write_bytes(content)
+    dst.write_bytes(b"stale content that must be truncated" * 1024 * 1024)
+    mocker.patch.object(
+        in_tftpd.fcntl, "ioctl", side_effect=OSError(errno.EOPNOTSUPP, "no reflink")
+    )
+    for call in unsupported_calls:
+        mocker.patch.object(
+            in_tftpd.os, call, side_effect=OSError(errno.EXDEV, "unsupported")
+        )
+
+    # Act
+    in_tftpd._fast_copyfile(str(src), str(dst))
+
+    # Assert
+    assert dst.read_bytes() == content
+
+
+def test_fast_copyfile_copy_error_removes_destination(mocker, tmp_path):
+    # Arrange
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.write_bytes(b"content")
+    mocker.patch.object(
+        in_tftpd.fcntl, "ioctl", side_effect=OSError(errno.EOPNOTSUPP, "no reflink")
+    )
+    mocker.patch.object(in_tftpd, "_copy_fd", side_effect=OSError(errno.EIO, "I/O"))
+
+    # Act & Assert
+    with pytest.raises(OSError):
+        in_tftpd._fast_copyfile(str(src), str(dst), exclusive=True)
+    assert not dst.exists()
+
+
+def test_manager_write_boot_files_distro_glob_directory(
+    mocker, tmp_path, api_mock_tftp, reset_singleton
+):
+    # Arrange
+    source_dir = tmp_path / "source"
+    (source_dir / "subdir").mkdir(parents=True)
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    manager_obj.bootloc = str(tmp_path)
+    mocker.patch.object(
+        in_tftpd.utils,
+        "blender",
+        return_value={"boot_files": {"$local_img_path/efi/": str(source_dir / "*")}},
+    )
+    mocker.patch.object(in_tftpd.utils, "is_safe_to_hardlink", return_value=False)
+    image_dir = tmp_path / "images" / "test"
+
+    # Act
+    result = manager_obj.write_boot_files_distro(api_mock_tftp.distros()[0])
+
+    # Assert
+    assert result == 0
+    assert not (image_dir / "efi" / "subdir").exists()
+
+
+def test_fast_copyfile_reflink(mocker, tmp_path):
+    # Arrange
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.write_bytes(b"content")
+    mocker.patch.object(in_tftpd, "_FICLONE", 0x40049409)
+    ioctl_mock = mocker.patch.object(in_tftpd.fcntl, "ioctl")
+    copy_fd_mock = mocker.patch.object(in_tftpd, "_copy_fd")
+
+    # Act
+    in_tftpd._fast_copyfile(str(src), str(dst))
+
+    # Assert
+    assert ioctl_mock.call_count == 1
+    assert ioctl_mock.call_args[0][1] == 0x40049409
+    assert copy_fd_mock.call_count == 0
+
+
+def test_fast_copyfile_copy_file_range_returns_zero(mocker, tmp_path):
+    # Arrange
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    content = os.urandom(1024 * 1024 + 17)
+    src.write_bytes(content)
+    mocker.patch.object(
+        in_tftpd.fcntl, "ioctl", side_effect=OSError(errno.EOPNOTSUPP, "no reflink")
+    )
+    copy_file_range_mock = mocker.patch.object(
+        in_tftpd.os, "copy_file_range", return_value=0
+    )
+
+    # Act
+    in_tftpd._fast_copyfile(str(src), str(dst))
+
+    # Assert
+    assert copy_file_range_mock.call_count == 1
+    assert dst.read_bytes() == content
+
+
+def test_manager_sync_distro_copy_error(mocker, api_mock_tftp, reset_singleton):
+    # Arrange
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    tftpgen_mock = MagicMock(spec=TFTPGen, autospec=True)
+    mocker.patch.object(manager_obj, "tftpgen", return_value=tftpgen_mock)
+    manager_obj.tftpgen.copy_single_distro_files.side_effect = CX("missing kernel")
+    logger_mock = mocker.patch.object(manager_obj, "logger")
+
+    # Act
+    manager_obj.sync()
+
+    # Assert
+    logger_mock.error.assert_called_once_with("missing kernel")
+    assert manager_obj.tftpgen.write_all_system_files.call_count == 1
+    assert manager_obj.tftpgen.make_pxe_menu.call_count == 1
+
+
+def test_fast_copyfile_exclusive(tmp_path):
+    # Arrange
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.write_bytes(b"new")
+    dst.write_bytes(b"existing")
+
+    # Act & Assert
+    with pytest.raises(FileExistsError):
+        in_tftpd._fast_copyfile(str(src), str(dst), exclusive=True)
+    assert dst.read_bytes() == b"existing"
+
+
+def test_manager_write_boot_files_distro_copies(
+    mocker, tmp_path, api_mock_tftp, reset_singleton
+):
+    # Arrange
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    (source_dir / "a.efi").write_bytes(b"a")
+    (source_dir / "b.efi").write_bytes(b"b")
+    (source_dir / "c.txt").write_bytes(b"c")
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    manager_obj.bootloc = str(tmp_path)
+    mocker.patch.object(
+        in_tftpd.utils,
+        "blender",
+        return_value={
+            "boot_files": {
+                "$local_img_path/efi/": str(source_dir / "*.efi"),
+                "$local_img_path/renamed.txt": str(source_dir / "c.txt"),
+            }
+        },
+    )
+    image_dir = tmp_path / "images" / "test"
+    image_dir.mkdir(parents=True)
+    hardlink_mock = mocker.patch.object(
+        in_tftpd.utils, "is_safe_to_hardlink", return_value=False
+    )
+
+    # Act
+    result = manager_obj.write_boot_files_distro(api_mock_tftp.distros()[0])
+
+    # Assert
+    assert result == 0
+    assert (image_dir / "efi" / "a.efi").read_bytes() == b"a"
+    assert (image_dir / "efi" / "b.efi").read_bytes() == b"b"
+    assert (image_dir / "renamed.txt").read_bytes() == b"c"
+    assert not (image_dir / "efi" / "c.txt").exists()
+    assert hardlink_mock.call_count == 2
+
+
+def test_manager_render_boot_files(mocker, api_mock_tftp, reset_singleton):
+    # Arrange
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    render_spy = mocker.spy(manager_obj.templar, "render")
+    boot_files = {
+        "$local_img_path/first": "/srv/first",
+        "$local_img_path/efi/": "$web_img_path/*.efi",
+    }
+    metadata = {"local_img_path": "/tftp/test", "web_img_path": "/srv/www/test"}
+
+    # Act
+    result = manager_obj._render_boot_files(boot_files, metadata)
+
+    # Assert
+    assert result == [
+        ("/tftp/test/first", "/srv/first"),
+        ("/tftp/test/efi/", "/srv/www/test/*.efi"),
+    ]
+    assert render_spy.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    ["*.efi", "a.efi", "missing.efi", ".*", "[ab].efi", "*/nested.efi", "none/*"],
+)
+def test_cached_glob(tmp_path, pattern):
+    # Arrange
+    for name in ("a.efi", "b.efi", "c.txt", ".hidden.efi"):
+        (tmp_path / name).write_bytes(b"")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "nested.efi").write_bytes(b"")
+    full_pattern = os.path.join(str(tmp_path), pattern)
+    dir_cache = {}
+
+    # Act
+    result = in_tftpd._cached_glob(full_pattern, dir_cache)
+    cached_result = in_tftpd._cached_glob(full_pattern, dir_cache)
+
+    # Assert
+    assert sorted(result) == sorted(glob.glob(full_pattern))
+    assert cached_result == result
+
+
+def test_tftpd_singleton_threads(mocker, reset_singleton):
+    # Arrange
+    init_mock = mocker.patch.object(
+        in_tftpd._InTftpdManager,
+        "__init__",
+        side_effect=lambda self, api: time.sleep(0.05),
+        autospec=True,
+    )
+    mcollection = Mock()
+
+    # Act
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        managers = list(
+            executor.map(lambda _: in_tftpd.get_manager(mcollection), range(8))
+        )
+
+    # Assert
+    assert init_mock.call_count == 1
+    assert all(manager is managers[0] for manager in managers)
+
+
+def test_manager_render_boot_files_directive(mocker, api_mock_tftp, reset_singleton):
+    # Arrange
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    render_spy = mocker.spy(manager_obj.templar, "render")
+    boot_files = {"#set $x = 'q'\n$x/a": "/srv/a", "$x/b": "/srv/b"}
+
+    # Act
+    result = manager_obj._render_boot_files(boot_files, {})
+
+    # Assert
+    assert result == [("q/a", "/srv/a"), ("$x/b", "/srv/b")]
+    assert render_spy.call_count == 2
+
+
+def test_manager_render_boot_files_jinja_statement(
+    mocker, api_mock_tftp, reset_singleton
+):
+    # Arrange
+    api_mock_tftp.settings().default_template_type = "jinja2"
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    render_spy = mocker.spy(manager_obj.templar, "render")
+    boot_files = {"{% set p = '/x' %}{{ p }}/a": "/srv/a", "{{ p }}/b": "/srv/b"}
+
+    # Act
+    result = manager_obj._render_boot_files(boot_files, {})
+
+    # Assert
+    assert result == [("/x/a", "/srv/a"), ("/b", "/srv/b")]
+    assert render_spy.call_count == 2
+
+
+def test_manager_render_boot_files_plain(mocker, api_mock_tftp, reset_singleton):
+    # Arrange
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    render_spy = mocker.spy(manager_obj.templar, "render")
+    boot_files = {"/tftp/test/first": "/srv/first", "/tftp/test/efi/": "/srv/*.efi"}
+
+    # Act
+    result = manager_obj._render_boot_files(boot_files, {})
+
+    # Assert
+    assert result == [
+        ("/tftp/test/first", "/srv/first"),
+        ("/tftp/test/efi/", "/srv/*.efi"),
+    ]
+    assert render_spy.call_count == 0
+
+
+def test_manager_menu_items_cache(mocker, api_mock_tftp, reset_singleton):
+    # Arrange
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    tftpgen_mock = MagicMock(spec=TFTPGen, autospec=True)
+    mocker.patch.object(manager_obj, "tftpgen", return_value=tftpgen_mock)
+
+    # Act
+    manager_obj.sync_single_system(None)
+    manager_obj.sync_single_system(None)
+    calls_unchanged = manager_obj.tftpgen.get_menu_items.call_count
+    manager_obj.profiles[0].mtime = 1.0
+    manager_obj.sync_single_system(None)
+
+    # Assert
+    assert calls_unchanged == 1
+    assert manager_obj.tftpgen.get_menu_items.call_count == 2
+
+
+@pytest.mark.parametrize("safe_to_hardlink", [True, False])
+def test_manager_copy_boot_file(
+    tmp_path, api_mock_tftp, reset_singleton, safe_to_hardlink
+):
+    # Arrange
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.write_bytes(b"content")
+
+    # Act
+    manager_obj._copy_boot_file(str(src), str(dst), safe_to_hardlink)
+
+    # Assert
+    assert dst.read_bytes() == b"content"
+    assert os.path.samefile(src, dst) == safe_to_hardlink
+    with pytest.raises(FileExistsError):
+        manager_obj._copy_boot_file(str(src), str(dst), safe_to_hardlink)
+
+
+def test_sync_systems_rebuilds_menu_items(mocker, api_mock_tftp, reset_singleton):
+    # Arrange
+    manager_obj = in_tftpd.get_manager(api_mock_tftp)
+    tftpgen_mock = MagicMock(spec=TFTPGen, autospec=True)
+    mocker.patch.object(manager_obj, "tftpgen", return_value=tftpgen_mock)
+    mocker.patch.object(manager_obj, "sync_single_system")
+
+    # Act
+    manager_obj.sync_systems(["test"])
+    manager_obj.sync_systems(["test"])
+
+    # Assert
+    assert manager_obj.tftpgen.get_menu_items.call_count == 2